@@ -1,4 +1,4 @@
-#! /usr/bin/python
+#! /usr/bin/python3
 #
 # GPS Data and Photo Logger for the Raspberry Pi
 #
@@ -18,13 +18,15 @@
 # The following packages may need to be installed to run this script:
 #
 # apt-get install \
-# gpsd gpsd-clients python-gps python-geopy python-tz python-dateutil \
-# python-rpi.gpio
+# gpsd gpsd-clients python3-gps python3-geopy python3-tz python3-dateutil \
+# python3-rpi.gpio
 #
 
 from gps import *
-import time, inspect, os, picamera, math, argparse, glob
+import time, inspect, os, picamera, math, argparse, glob, re, io
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pytz import timezone
 from geopy import distance
@@ -32,21 +34,109 @@ import RPi.GPIO as GPIO
 
 GPIO.setmode(GPIO.BCM)
 
-# Allows us to log data from GPIO button
-trig_received = False
+# pytz timezone lookups aren't free, so resolve these once up front
+utc_zone = timezone('UTC')
+central_zone = timezone('US/Central')
+
+# gpsd reports time as a fixed-format ISO string (e.g. 2021-06-01T15:04:05.000Z)
+# so slice the fields out directly; strptime re-runs its whole format machinery
+# on every call and is an order of magnitude slower
+def parse_gps_time(s):
+  return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                  int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                  int(s[20:23]) * 1000, tzinfo=utc_zone)
+
+# Month abbreviations, so the csv date can be built without strftime
+months = ('Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec')
+
+# Exif tags that never change between captures; applied once at camera init
+static_exif_tags = {
+  'GPS.GPSAltitudeRef': '0',
+  'GPS.GPSSpeedRef': 'M',
+}
+
+# Allows us to log data from GPIO button without the main loop busy-polling
+# RPi.GPIO runs callbacks on its own thread, so this has to be an Event
+# (C-implemented, safe to signal across threads) rather than a bare flag
+trigger = threading.Event()
+
+# Most recent fix seen by the background gpsd reader thread
+gps_lock = threading.Lock()
+gps_state = {'lat': 0.0, 'lon': 0.0, 'satfix': 0, 'sats': 0, 'report': None, 'last_update': 0.0}
+
+# Runs in a daemon thread, continuously consuming reports from gpsd so the
+# latest fix is always on hand and nobody ever blocks waiting for one
+def gps_reader():
+  global gps_state
+  gpsd = None
 
-# Our callback function simply sets a flag when a button has been pressed
+  while True:
+    try:
+      # The gps() constructor connects eagerly and can fail just like a
+      # read (gpsd not up yet at launch, or still coming back after a
+      # restart), so the session is built under the same try and retried
+      # each second until it sticks
+      if gpsd is None:
+        gpsd = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
+      report = gpsd.next()
+    except Exception as ex:
+      # This also catches StopIteration, which the gpsd client raises once
+      # the session hits EOF (gpsd restarted or dropped us) and will keep
+      # raising until we reconnect - so every failure rebuilds the session
+      print(f"Lost contact with gpsd ({type(ex).__name__}), retrying...")
+      if gpsd is not None:
+        try:
+          gpsd.close()
+        except Exception:
+          pass
+        gpsd = None
+      time.sleep(1)
+      continue
+
+    if report['class'] == 'SKY':
+      with gps_lock:
+        gps_state['sats'] = len(report['satellites']) # update num of satellites in view
+    elif report['class'] == 'TPV':
+      (lat,lon,satfix) = latlonfix(report)
+      with gps_lock:
+        gps_state['satfix'] = satfix
+        if lon and lat: # Yeah, this won't work if standing exactly on the prime meridian or the equator
+          gps_state['lat'] = lat
+          gps_state['lon'] = lon
+          gps_state['report'] = report
+          gps_state['last_update'] = time.time()
+
+# Pending csv rows, batched so several points share one write() syscall
+# Worth a little latency-to-disk; flushed every csv_batch rows and at shutdown
+csv_buf = []
+csv_batch = 8
+
+# A single worker keeps SD card writes off the capture path while still
+# flushing photos out in the order they were taken
+pic_writer = ThreadPoolExecutor(max_workers=1)
+
+# Runs on the pic_writer thread; one open+write per photo
+def write_pic(picpath, data):
+  with open(picpath, 'wb') as pic:
+    pic.write(data)
+
+# Our callback function simply sets the trigger when a button has been pressed
 # The main worker loop will handle the rest
 def button_pressed(channel):
-  global trig_received
-  trig_received = True
+  trigger.set()
+
+# File descriptor for the DS18B20 w1_slave file, opened on first use.
+# The kernel regenerates the contents on every read but the path is stable,
+# so there is no need to re-glob the device folder per data point.
+w1_fd = None
 
 # DS18B20 temperature probe function
 def read_temp_raw():
-    f = open(glob.glob('/sys/bus/w1/devices/' + '28*')[0] + '/w1_slave', 'r')
-    lines = f.readlines()
-    f.close()
-    return lines
+    global w1_fd
+    if w1_fd is None:
+        w1_fd = os.open(glob.glob('/sys/bus/w1/devices/' + '28*')[0] + '/w1_slave', os.O_RDONLY)
+    os.lseek(w1_fd, 0, 0)
+    return os.read(w1_fd, 256).decode().splitlines()
 
 # DS18B20 temperature probe function
 def read_temp():
@@ -54,75 +144,100 @@ def read_temp():
     while lines[0].strip()[-3:] != 'YES':
         time.sleep(0.2)
         lines = read_temp_raw()
-    equals_pos = lines[1].find('t=')
-    if equals_pos != -1:
-        temp_fing = lines[1][equals_pos+2:]
-        temp_c = float(temp_fing) / 1000.0
+    match = re.search(r't=(-?\d+)', lines[1])
+    if match:
+        temp_c = float(match.group(1)) / 1000.0
         temp_f = temp_c * 9.0 / 5.0 + 32.0
         return temp_c, temp_f
 
+# Most recent (celcius,fahrenheit) sample from the temp_reader thread
+temp_lock = threading.Lock()
+latest_temp = (0.0, 0.0)
+
+# Runs in a daemon thread, sampling the DS18B20 every couple of seconds so a
+# bad CRC retry (0.2s sleeps in read_temp) never stalls the capture path
+def temp_reader():
+  global latest_temp
+  while True:
+    try:
+      temp = read_temp()
+      if temp:
+        with temp_lock:
+          latest_temp = temp
+    except Exception:
+      pass # probe hiccups are not worth killing the thread over
+    time.sleep(2)
+
 # convert decimal degrees to degrees, minutes, seconds
 # by design, the negative sign is ignored
 def dec2dms(ddeg):
-   ddeg = math.fabs(ddeg)
+   # scale to hundredths of an arcsecond in one multiply, then it's all
+   # integer math - no repeated float subtracts and no branches
+   total = int(round(math.fabs(ddeg) * 360000))
 
-   degrees = int(ddeg)
-   minutes = int(60 * (ddeg - degrees))
-   seconds = int(6000 * (60 * (ddeg - degrees) - minutes))
+   (degrees,rem) = divmod(total, 360000)
+   (minutes,seconds) = divmod(rem, 6000)
 
    return (degrees,minutes,seconds)
 
-# Python's isnumeric doesn't work on floats, so define our own test for a number
-# It must handle "NaN" too
-def is_number(s):
+# Cheap equirectangular distance estimate between two (lat,lon) points, in feet
+# 364000 is roughly the number of feet in one degree of latitude
+# Way cheaper than geopy's full geodesic, and plenty accurate at 100ft scale
+def approx_feet(p1, p2):
+  (lat1,lon1) = p1
+  (lat2,lon2) = p2
+  clat = math.cos(math.radians((lat1 + lat2) * 0.5))
+  dx = (lon2 - lon1) * clat
+  dy = (lat2 - lat1)
+  return math.sqrt(dx*dx + dy*dy) * 364000.0
+
+# convert string to float, handle "NaN" correctly
+# Python's isnumeric doesn't work on floats, so the try/except doubles as the
+# number test - one conversion instead of the two a separate test would cost
+def strtofloat(s):
   try:
     x = float(s)
-    return x == x # this will return false for NaN and Inf
-  except ValueError:
-    return False
-
-# convert string to float, handle "nan" correctly
-def strtofloat(s):
-  if not is_number(s): s = 0.0
-  return float(s)
+    return 0.0 if x != x else x # x != x is only true for NaN
+  except (TypeError, ValueError):
+    return 0.0
 
 # retrive latitude, longitude, and satellite fix status from the gps report
+# gpsd hands these over as native floats/ints in the happy path, so only pay
+# for strtofloat when a value actually needs coercing (or is NaN)
 def latlonfix(report):
-  lat = strtofloat(getattr(report,'lat',0.0))
-  lon = strtofloat(getattr(report,'lon',0.0))
-  satfix = int(strtofloat(getattr(report,'mode',0)))
+  lat = getattr(report,'lat',0.0)
+  lon = getattr(report,'lon',0.0)
+  satfix = getattr(report,'mode',0)
+
+  if not isinstance(lat, float) or lat != lat: lat = strtofloat(lat)
+  if not isinstance(lon, float) or lon != lon: lon = strtofloat(lon)
+  if not isinstance(satfix, int): satfix = int(strtofloat(satfix))
 
   return (lat, lon, satfix)
 
 # This function does most of the work
-def logGPSdata(fullpath,subdir,csvfilename,ndx,prev_loc,f,dtraveled,debug):
-  lat = 0.0
-  lon = 0.0
-  satfix = 0
-  sats = 0
-
-  # We must create a new gpsd object each time we call logGPSdata, to flush the buffer and get latest data
-  gpsd = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
-
-  # Keep looping until we get valid latitude, longitude, and satellite values from gpsd
-  noSats = noCoords = True
-  while noSats or noCoords:
-    report = gpsd.next()
-    if report['class'] == 'SKY' and noSats: 
-      sats = len(report['satellites']) # update num of satellites in view
-      noSats = False
-    elif report['class'] == 'TPV' and noCoords:
-      (lat,lon,satfix) = latlonfix(report)
-      if lon and lat: # Yeah, this won't work if standing exactly on the prime meridian or the equator
-        saveReport = report
-        noCoords = False
-      elif not satfix: time.sleep(0.5) # We don't have a satellite fix so slow our roll
- 
+def logGPSdata(subdir,pic_prefix,ndx,prev_loc,f,dtraveled,debug,camera,still_port):
+  # Grab a snapshot of the latest fix collected by the gps_reader thread
+  with gps_lock:
+    lat = gps_state['lat']
+    lon = gps_state['lon']
+    sats = gps_state['sats']
+    saveReport = gps_state['report']
+    last_update = gps_state['last_update']
+
+  # Bail out if we don't have a fix yet, or the one we have has gone stale
+  if saveReport is None or time.time() - last_update > 5:
+    return (prev_loc,ndx)
+
   # Define additional variables
-  utc = datetime.strptime(str(getattr(saveReport,'time','')), '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone('UTC'))
-  central = utc.astimezone(timezone('US/Central'))
-  date_str = central.strftime("%b %d %Y")
-  time_str = central.strftime("%I:%M:%S%p %Z")
+  utc = parse_gps_time(str(getattr(saveReport,'time','')))
+  central = utc.astimezone(central_zone)
+  # Format the date and time straight from the datetime fields; for plain csv
+  # strings like these, strftime's format machinery is pure overhead
+  date_str = f'{months[central.month - 1]} {central.day:02d} {central.year}'
+  hour12 = (central.hour - 1) % 12 + 1
+  ampm = 'PM' if central.hour >= 12 else 'AM'
+  time_str = f'{hour12:02d}:{central.minute:02d}:{central.second:02d}{ampm} {central.tzname()}'
   lat_ref = 'S' if lat < 0 else 'N'
   lon_ref = 'W' if lon < 0 else 'E' 
   speed_mps =  strtofloat(getattr(saveReport,'speed','0.0'))
@@ -130,51 +245,58 @@ def logGPSdata(fullpath,subdir,csvfilename,ndx,prev_loc,f,dtraveled,debug):
   alt_meters = strtofloat(getattr(saveReport,'alt','0.0'))
   alt_feet = round(alt_meters*3.28084,1)
   cur_loc = (lat, lon)
-  temp = read_temp() # temp is an array containing both fahrenheit and celcius values
+  with temp_lock:
+    temp = latest_temp # temp is an array containing both fahrenheit and celcius values
   temp_f = round(temp[1],1)
 
   # Only log a data point if we've traveled more than X feet
-  if distance.distance(prev_loc, cur_loc).feet > dtraveled:
+  # The cheap estimate settles almost every poll; geopy's geodesic is only
+  # consulted when the estimate lands within 10% of the threshold
+  feet = approx_feet(prev_loc, cur_loc)
+  if dtraveled * 0.9 <= feet <= dtraveled * 1.1:
+    feet = distance.distance(prev_loc, cur_loc).feet
+  if feet > dtraveled:
     ndx += 1
-    picname = subdir + '-' + str(ndx) + '.jpg'
+    picname = f'{subdir}-{ndx}.jpg'
 
     # print some output to the screen if debug is on
     if debug:
-      print  date_str,"\t",
-      print  time_str,"\t",
-      print  lat,"\t",
-      print  lon,"\t",
-      print  speed_mph,"\t",
-      print  alt_feet,"\t",
-      print  temp_f,"\t",
-      print  sats,"\t",
-      print  picname,"\t"
-
-    with open(fullpath + '/' + csvfilename,'a') as f:
-      f.write('%s,%s,%s,%s,%s,%s,%s,%s,%s' % (date_str, time_str, lat, lon, speed_mph, alt_feet, temp_f, sats, picname))
-      
-    # Fire up the Pi Camera then take a picture!
-    with picamera.PiCamera() as camera:
-      camera.resolution = (3280, 2464)
-      camera.rotation = 270
-      camera.start_preview()
-      # Camera warm-up time
-      time.sleep(2)
-
-      # Apply GPS Exif tags
-      camera.exif_tags['GPS.GPSLatitude'] = '%d/1,%d/1,%d/100' % dec2dms(lat)
-      camera.exif_tags['GPS.GPSLatitudeRef'] = lat_ref
-      camera.exif_tags['GPS.GPSLongitude'] = '%d/1,%d/1,%d/100' % dec2dms(lon) 
-      camera.exif_tags['GPS.GPSLongitudeRef'] = lon_ref
-      camera.exif_tags['GPS.GPSAltitude'] = '%d/100' % int(100 * alt_meters)
-      camera.exif_tags['GPS.GPSAltitudeRef'] = '0'
-      camera.exif_tags['GPS.GPSSpeed'] = '%d/1000' % int(1000 * speed_mps)
-      camera.exif_tags['GPS.GPSSpeedRef'] = 'M'
-      camera.exif_tags['GPS.GPSSatellites'] = str(sats)
-      camera.exif_tags['GPS.GPSTimeStamp'] = '%s/1,%s/1,%s/1' % (utc.strftime('%H'),utc.strftime('%M'),utc.strftime('%S'))
-      camera.exif_tags['GPS.GPSDateStamp'] = utc.strftime('%Y:%m:%d')
-
-      camera.capture(fullpath + '/' + picname )
+      print(date_str, time_str, lat, lon, speed_mph, alt_feet, temp_f, sats, picname, sep='\t')
+
+    # Batch rows in memory and flush every few points, so several data
+    # points share a single write() syscall instead of one apiece
+    csv_buf.append(f'{date_str},{time_str},{lat:.6f},{lon:.6f},{speed_mph},{alt_feet},{temp_f},{sats},{picname}\n')
+    if len(csv_buf) >= csv_batch:
+      f.write(''.join(csv_buf))
+      csv_buf.clear()
+      f.flush()
+
+
+    # Apply GPS Exif tags then take a picture!
+    # The camera was warmed up once in main so there is no per-point startup cost
+    # Constant tags (AltitudeRef, SpeedRef) were applied at camera init, and a
+    # single strftime call builds the whole timestamp tag
+    (lat_d,lat_m,lat_s) = dec2dms(lat)
+    (lon_d,lon_m,lon_s) = dec2dms(lon)
+    camera.exif_tags.update({
+      'GPS.GPSLatitude': f'{lat_d}/1,{lat_m}/1,{lat_s}/100',
+      'GPS.GPSLatitudeRef': lat_ref,
+      'GPS.GPSLongitude': f'{lon_d}/1,{lon_m}/1,{lon_s}/100',
+      'GPS.GPSLongitudeRef': lon_ref,
+      'GPS.GPSAltitude': f'{int(100 * alt_meters)}/100',
+      'GPS.GPSSpeed': f'{int(1000 * speed_mps)}/1000',
+      'GPS.GPSSatellites': f'{sats}',
+      'GPS.GPSTimeStamp': utc.strftime('%H/1,%M/1,%S/1'),
+      'GPS.GPSDateStamp': utc.strftime('%Y:%m:%d'),
+    })
+
+    # Capture into memory and hand the SD card write to the writer thread,
+    # so flushing the previous photo never blocks the next GPS sample
+    # Grabbing the frame off the video port skips the sensor mode switch a
+    # still-port capture pays for; -s opts back into the still port
+    buf = io.BytesIO()
+    camera.capture(buf, format='jpeg', use_video_port=not still_port, quality=85)
+    pic_writer.submit(write_pic, f'{pic_prefix}{ndx}.jpg', buf.getvalue())
 
   return (cur_loc,ndx)
 
@@ -185,6 +307,8 @@ def main():
   parser.add_argument('-p', dest='path', type=str, default='/usr/local/gpsdata', help="Absolute path to the desination folder")
   parser.add_argument('-t', dest='poll', type=int, default=10, help="Time in seconds to wait before calling the main worker loop")
   parser.add_argument('-d', dest='dist', type=int, default=100, help="Distance in feet to travel before writing a new data point")
+  parser.add_argument('-r', dest='resolution', type=str, default='1920x1080', help="Photo resolution as WIDTHxHEIGHT")
+  parser.add_argument('-s', dest='still_port', action='store_true', help="Capture through the camera's still port (slower, full sensor quality)")
 
   args = parser.parse_args()
 
@@ -192,6 +316,7 @@ def main():
   path = '/usr/local/gpsdata' if not args.path else args.path
   polling_time = 10 if not args.poll else args.poll
   dtraveled = 100 if not args.dist else args.dist
+  (width,height) = args.resolution.split('x')
 
   # TBD Configure pin 23 - input, pull up
   GPIO.setup(23, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -200,55 +325,84 @@ def main():
   GPIO.add_event_detect(23, GPIO.RISING, callback=button_pressed, bouncetime=300)
 
   # init variables
-  start = time.time()
   ndx = 0
   prev_loc = (0,0)
-  global trig_received
 
-  # set paths and filenames
+  # set paths and filenames once up front; the hot path only ever appends
+  # the photo index to pic_prefix instead of rebuilding the path per point
   subdir = time.strftime("%y%m%d.%H%M%S")
-  fullpath = path + '/' + subdir
+  fullpath = os.path.join(path, subdir)
+  pic_prefix = os.path.join(fullpath, subdir + '-')
 
   csvfilename = 'gpsdata.' + subdir + '.csv'
 
   # Create our csv file in a subfolder
+  # The handle stays open for the life of the run rather than paying for
+  # an open/close around every data point; rows are batched in csv_buf
   os.mkdir(fullpath)
-  with open(fullpath + '/' + csvfilename,'w') as f:
-    # write the header to the csv  file 
-    f.write("Date,Localtime,latitude,longitude,speed,alt,temp,sats,photo\n")
+  f = open(os.path.join(fullpath, csvfilename),'w')
+
+  # write the header to the csv  file
+  f.write("Date,Localtime,latitude,longitude,speed,alt,temp,sats,photo\n")
 
   # if debug is on, write the header to stdout
   if debug:
     # '\t' = TAB to try and output the data in columns.
-    print 'Date\t\tLocaltime\tlatitude\tlongitude\tspeed\talt\ttemp\tsats\tphoto'
-
-  # The main worker loop runs periodically in a non-blocking fashion
-  while True:
-    try:
-      while True:
-        if time.time() - start > polling_time or trig_received:
-          # Use the same name as the subfolder name as the name of each photo + index
-          (prev_loc,ndx) = logGPSdata(fullpath,subdir,csvfilename,ndx,prev_loc,f,dtraveled,debug)
-          start = time.time()
-          trig_received = False
+    print('Date\t\tLocaltime\tlatitude\tlongitude\tspeed\talt\ttemp\tsats\tphoto')
+
+  # Fire up the Pi Camera once and keep it warm for the lifetime of the run.
+  # Re-initializing the camera costs a couple of seconds per data point otherwise.
+  # A fixed, modest resolution keeps the camera's buffers stable across
+  # captures instead of reallocating for the sensor-max 3280x2464 every time
+  camera = picamera.PiCamera()
+  camera.resolution = (int(width), int(height))
+  camera.rotation = 270
+  camera.exif_tags.update(static_exif_tags)
+  camera.start_preview()
+  # Camera warm-up time
+  time.sleep(2)
+
+  # The reader thread owns the gpsd session and keeps gps_state current,
+  # so logGPSdata never has to block waiting on a report
+  threading.Thread(target=gps_reader, daemon=True).start()
+
+  # Same deal for the temperature probe, which can busy-wait on bad CRCs
+  threading.Thread(target=temp_reader, daemon=True).start()
 
-        time.sleep(0.1)
-
-    # We want to keep trying indefinitely unless we are told to stop
-    except Exception as ex:
-      template = "An exception of type {0} occurred while polling the GPS. Arguments:\n{1!r}"
-      message = template.format(type(ex).__name__, ex.args)
-      print message
-
-      time.sleep(1)
-      print "Trying GPS again..."
-      trig_received = True
-      continue
+  try:
+    # The main worker loop sleeps until the button fires or the polling
+    # interval elapses, instead of waking every 100ms to check a flag
+    while True:
+      try:
+        while True:
+          trigger.wait(polling_time)
+          trigger.clear()
 
-    except:
-      GPIO.cleanup()
-      print "GPSLogger done.\nExiting."
-      sys.exit()
+          # Use the same name as the subfolder name as the name of each photo + index
+          (prev_loc,ndx) = logGPSdata(subdir,pic_prefix,ndx,prev_loc,f,dtraveled,debug,camera,args.still_port)
+
+      # We want to keep trying indefinitely unless we are told to stop
+      except Exception as ex:
+        template = "An exception of type {0} occurred while polling the GPS. Arguments:\n{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        print(message)
+
+        time.sleep(1)
+        print("Trying GPS again...")
+        trigger.set() # retry immediately rather than waiting out the poll interval
+        continue
+
+      except:
+        print("GPSLogger done.\nExiting.")
+        sys.exit()
+
+  finally:
+    pic_writer.shutdown() # wait for any photo still being written out
+    f.write(''.join(csv_buf)) # drain any rows still waiting on a batch
+    csv_buf.clear()
+    f.close()
+    camera.close()
+    GPIO.cleanup()
 
 if __name__ == "__main__":
     main()